@@ -1,17 +1,24 @@
-import requests
+import httpx
+import asyncio
 import csv
-import pandas as pd
+import gzip
+import shutil
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import os
 import json
+import orjson
+import base64
+import time
+import itertools
+import threading
+from collections import defaultdict
 import logging
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+import sqlite3
+from email.message import EmailMessage
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
 
 # Load environment variables from .env file
 load_dotenv()
@@ -21,10 +28,17 @@ API_USERNAME = os.getenv('API_USERNAME')
 PASSWORD = os.getenv('PASSWORD')
 CLIENT_KEY = os.getenv('CLIENT_KEY')
 PAGE = int(os.getenv('PAGE', 1))
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', 5000))
 LIMIT = int(os.getenv('LIMIT', 10000000))
 ORDERS = json.loads(os.getenv('ORDERS', '["syncTime DESC"]'))
+# Maximum rows in one Excel worksheet, including the header row
+XLSX_MAX_ROWS = 1048576
+# Optional unique tiebreaker appended to ORDERS so pages split the device list at stable boundaries
+PAGINATION_ORDER = os.getenv('PAGINATION_ORDER', '')
 CSV_OUTPUT_FILE = os.getenv('CSV_OUTPUT_FILE', 'devices.csv')
 XLSX_OUTPUT_FILE = os.getenv('XLSX_OUTPUT_FILE', 'devices.xlsx')
+ATTACHMENT_FORMAT = os.getenv('ATTACHMENT_FORMAT', 'xlsx').lower()
+ATTACHMENT_FORMATS = ('xlsx', 'csv.gz', 'none')
 IPINFO_TOKEN = os.getenv('IPINFO_TOKEN')
 SMTP_SERVER = os.getenv('SMTP_SERVER')
 SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
@@ -40,16 +54,56 @@ SEND_EMAIL = os.getenv('SEND_EMAIL', 'TRUE').upper() == 'TRUE'
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger()
 
+# Checked up front, since an unknown format would otherwise silently skip the XLSX export
+if ATTACHMENT_FORMAT not in ATTACHMENT_FORMATS:
+    logging.warning("Unknown ATTACHMENT_FORMAT %s, expected one of %s. Using xlsx.", ATTACHMENT_FORMAT, ', '.join(ATTACHMENT_FORMATS))
+    ATTACHMENT_FORMAT = 'xlsx'
+# The XLSX export is only built when it is the configured attachment format
+WRITE_XLSX = bool(XLSX_OUTPUT_FILE) and ATTACHMENT_FORMAT == 'xlsx'
+
+# ipinfo.io batch settings (the batch endpoint accepts up to 1000 addresses per request)
+IPINFO_BATCH_SIZE = 1000
+IPINFO_CONCURRENCY = 32
+
+# IP info cache database, and how long its records are trusted before a refresh (seconds)
+IP_INFO_DB = 'ip_info.db'
+IP_INFO_TTL = 30 * 86400
+IP_INFO_ERROR_TTL = 3600
+
+# Base URL of the KRMS API, and the timeout applied to all HTTP requests
+KRMS_BASE_URL = "https://www.krms.openview.co.za"
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+# Cached API token, reused across runs until it expires while the API account is unchanged
+TOKEN_FILE = os.getenv('TOKEN_FILE', '.krms_token.json')
+TOKEN_TTL = int(os.getenv('TOKEN_TTL', 3600))  # Used when the token carries no exp claim
+TOKEN_EXPIRY_MARGIN = 60
+# Serialises token renewal between the concurrent start-up requests
+_TOKEN_REFRESH_LOCK = threading.Lock()
+
 # File for the final report
 REPORT_FILE = 'krms_devices_report.html'
 
-class IPFetchError(Exception):
-    """Custom exception for IP fetch failures."""
+class TokenError(Exception):
+    """Custom exception for token request failures."""
+    pass
+
+class ExportError(Exception):
+    """Custom exception for export file write failures."""
     pass
 
-def request_token() -> str:
-    """Request an API token."""
-    token_url = "https://www.krms.openview.co.za/auth/v1/token"
+def _token_expiry(token: str) -> float:
+    """Return the expiry of a JWT from its exp claim, falling back to TOKEN_TTL from now."""
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + TOKEN_TTL
+
+def request_token(session: httpx.Client) -> Tuple[str, float]:
+    """Request an API token, returning it with its expiry as epoch seconds."""
+    token_url = f"{KRMS_BASE_URL}/auth/v1/token"
     headers = {
         "Content-Type": "application/json;charset=utf-8",
         "User-Agent": "Mozilla/5.0"
@@ -60,119 +114,234 @@ def request_token() -> str:
         "clientKey": CLIENT_KEY
     }
     try:
-        response = requests.post(token_url, headers=headers, json=data)
+        response = session.post(token_url, headers=headers, json=data)
         response.raise_for_status()
         token_response = response.json()
         if token_response.get("code") == "success":
             logging.info("Token received successfully.")
-            return token_response.get("token")
+            token = token_response.get("token")
+            return token, _token_expiry(token)
         else:
             logging.error("Failed to get token. Response code: %s", token_response.get("code"))
-            raise Exception("Failed to get token.")
-    except requests.RequestException as e:
+            raise TokenError("Failed to get token.")
+    except (httpx.HTTPError, ValueError) as e:
         logging.error("Error requesting token: %s", e)
-        raise
-
-def request_data(url: str, headers: dict, data: dict = None) -> dict:
-    """Request data from the API."""
-    try:
-        response = requests.post(url, headers=headers, json=data) if data else requests.get(url, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
-        logging.error("Error requesting data from %s: %s", url, e)
-        raise
+        raise TokenError(f"Error requesting token: {e}") from e
 
-def load_ip_info(file_path: str = 'ip_info.json') -> Dict[str, Any]:
-    """Load IP info from a JSON file."""
+def load_token(file_path: str = TOKEN_FILE) -> Optional[str]:
+    """Load the cached API token if it has not expired and was issued for the configured API account."""
     try:
         if os.path.exists(file_path):
             with open(file_path, 'r') as file:
-                logging.info("Loaded IP info from %s", file_path)
-                return json.load(file)
+                cached = json.load(file)
+            if cached.get('user') != API_USERNAME or cached.get('clientKey') != CLIENT_KEY:
+                logging.info("Cached token belongs to another API account, ignoring it.")
+                return None
+            if cached.get('exp', 0) > time.time() + TOKEN_EXPIRY_MARGIN:
+                return cached.get('token')
     except Exception as e:
-        logging.error("Error loading IP info: %s", e)
-    return {}
+        logging.error("Error loading token: %s", e)
+    return None
 
-def save_ip_info(ip_info: Dict[str, Any], file_path: str = 'ip_info.json') -> None:
-    """Save IP info to a JSON file."""
+def save_token(token: str, expires_at: float, file_path: str = TOKEN_FILE) -> None:
+    """Save the API token, its expiry and the API account it belongs to in a file readable only by the current user."""
     try:
-        with open(file_path, 'w') as file:
-            json.dump(ip_info, file)
-            logging.info("Saved IP info to %s", file_path)
+        with open(os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as file:
+            json.dump({'token': token, 'exp': expires_at, 'user': API_USERNAME, 'clientKey': CLIENT_KEY}, file)
     except Exception as e:
-        logging.error("Error saving IP info: %s", e)
-
-def fetch_ip_info(ip_address: str, ip_info_cache: Dict[str, Any]) -> Dict[str, Any]:
-    """Fetch IP information, using cache if available."""
-    if ip_address in ip_info_cache:
-        return ip_info_cache[ip_address]
-
-    url = f"https://ipinfo.io/{ip_address}?token={IPINFO_TOKEN}"
+        logging.error("Error saving token: %s", e)
+
+def get_token(session: httpx.Client, refresh: bool = False) -> str:
+    """Return the cached API token, requesting and caching a new one if missing, expired or refresh is set."""
+    token = None if refresh else load_token()
+    if token:
+        logging.info("Using cached token.")
+        return token
+    token, expires_at = request_token(session)
+    save_token(token, expires_at)
+    return token
+
+def request_data(session: httpx.Client, url: str, headers: dict, data: dict = None, retry_auth: bool = True) -> dict:
+    """Request data from the API, renewing the token once if it is rejected."""
     try:
-        response = requests.get(url)
+        authorization = headers.get("Authorization")
+        response = session.post(url, headers=headers, json=data) if data else session.get(url, headers=headers)
+        if response.status_code == 401 and retry_auth:
+            with _TOKEN_REFRESH_LOCK:
+                # Requests sharing these headers may have been rejected together; only the first renews the token
+                if headers.get("Authorization") == authorization:
+                    logging.info("Token rejected, requesting a new one...")
+                    headers["Authorization"] = f"Bearer {get_token(session, refresh=True)}"
+            return request_data(session, url, headers, data, retry_auth=False)
         response.raise_for_status()
-        ip_info_cache[ip_address] = response.json()
-        save_ip_info(ip_info_cache)
-        return ip_info_cache[ip_address]
-    except requests.RequestException as e:
-        raise IPFetchError(f"Failed to fetch data for {ip_address}: {e}")
+        return response.json()
+    except (httpx.HTTPError, ValueError) as e:
+        logging.error("Error requesting data from %s: %s", url, e)
+        raise
 
-def generate_report(stats: Dict[str, Any], retailers: Dict[str, Dict[str, int]]) -> str:
-    """Generate a report with the collected statistics and return the report as a string."""
-    report_content = f"""
+def _json_ip_info_row(ip_address: str, record: Dict[str, Any]) -> tuple:
+    """Convert a record from the old ip_info.json cache into an ip_info table row."""
+    if 'ts' not in record:
+        # Records saved before expiry tracking are bare ipinfo.io responses of unknown age
+        return ip_address, orjson.dumps(record), 0
+    data = record['data']
+    return ip_address, None if data is None else orjson.dumps(data), int(record['ts'])
+
+def load_ip_info(db_path: str = IP_INFO_DB, json_path: str = 'ip_info.json') -> sqlite3.Connection:
+    """Open the IP info cache database, importing the old JSON cache on first use."""
+    conn = sqlite3.connect(db_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS ip_info(ip TEXT PRIMARY KEY, data BLOB, ts INTEGER)')
+    if conn.execute('SELECT 1 FROM ip_info LIMIT 1').fetchone() is None and os.path.exists(json_path):
+        try:
+            with open(json_path, 'rb') as file:
+                ip_info = orjson.loads(file.read())
+            conn.executemany('INSERT OR REPLACE INTO ip_info (ip, data, ts) VALUES (?, ?, ?)',
+                             (_json_ip_info_row(ip, record) for ip, record in ip_info.items()))
+            conn.commit()
+            logging.info("Imported %d IP info records from %s", len(ip_info), json_path)
+        except Exception as e:
+            conn.rollback()
+            logging.error("Error importing IP info: %s", e)
+    logging.info("Loaded IP info from %s", db_path)
+    return conn
+
+def save_ip_info(conn: sqlite3.Connection) -> None:
+    """Commit any new or refreshed IP info to the cache database."""
+    try:
+        if conn.in_transaction:
+            conn.commit()
+            logging.info("Saved IP info to %s", IP_INFO_DB)
+    except Exception as e:
+        logging.error("Error saving IP info: %s", e)
+
+def is_ip_info_fresh(has_data: bool, ts: float, now: float) -> bool:
+    """Check whether a cache record is within its TTL (shorter for failed lookups)."""
+    ttl = IP_INFO_TTL if has_data else IP_INFO_ERROR_TTL
+    return now - ts < ttl
+
+def _ip_info_record(ip_address: str, data: Optional[bytes]) -> Dict[str, Any]:
+    """Decode a cached ip_info row, mapping NULL data from older caches to an error record."""
+    if data is None:
+        return {'error': f"Failed to fetch data for {ip_address}"}
+    return orjson.loads(data)
+
+async def _fetch_batch(client: httpx.AsyncClient, ip_addresses: List[str], sem: asyncio.Semaphore) -> Dict[str, Any]:
+    """POST one chunk of addresses to the ipinfo.io batch endpoint, returning {} on failure."""
+    url = f"https://ipinfo.io/batch?token={IPINFO_TOKEN}"
+    async with sem:
+        try:
+            response = await client.post(url, json=ip_addresses)
+            response.raise_for_status()
+            batch = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logging.error("Failed to fetch batch of %d addresses: %s", len(ip_addresses), e)
+            return {}
+    if not isinstance(batch, dict):
+        logging.error("Unexpected response for batch of %d addresses: %r", len(ip_addresses), batch)
+        return {}
+    return batch
+
+async def _gather(chunks: List[List[str]]) -> Dict[str, Any]:
+    """Fetch all chunks concurrently and merge the results."""
+    sem = asyncio.Semaphore(IPINFO_CONCURRENCY)
+    results = {}
+    async with httpx.AsyncClient(http2=True, timeout=HTTP_TIMEOUT, limits=httpx.Limits(max_connections=64)) as client:
+        for batch in await asyncio.gather(*(_fetch_batch(client, chunk, sem) for chunk in chunks)):
+            results.update(batch)
+    return results
+
+def fetch_ip_info_batch(ip_addresses: List[str], conn: sqlite3.Connection, cached: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Fetch IP information for many addresses via the ipinfo.io batch endpoint into the cache, returning the new records."""
+    chunks = [ip_addresses[i:i + IPINFO_BATCH_SIZE] for i in range(0, len(ip_addresses), IPINFO_BATCH_SIZE)]
+    results = asyncio.run(_gather(chunks))
+    now = int(time.time())
+    records = {}
+    for ip in ip_addresses:
+        if isinstance(results.get(ip), dict):
+            records[ip] = results[ip]
+        elif ip not in cached or 'error' in cached[ip]:
+            # Error record so a failing address is not retried until IP_INFO_ERROR_TTL passes;
+            # an expired record with data is left alone and keeps being served until a refresh succeeds
+            records[ip] = {'error': f"Failed to fetch data for {ip}"}
+    conn.executemany('INSERT OR REPLACE INTO ip_info (ip, data, ts) VALUES (?, ?, ?)',
+                     ((ip, orjson.dumps(record), now) for ip, record in records.items()))
+    return records
+
+def prefetch_ip_info(devices: List[dict], conn: sqlite3.Connection) -> Dict[str, Dict[str, Any]]:
+    """Return IP information for every address in a page of devices, batch-fetching any uncached or expired ones."""
+    now = time.time()
+    ip_info = {}
+    missing = []
+    for ip_address in {d['locationIp'] for d in devices if d.get('locationIp')}:
+        row = conn.execute('SELECT data, ts FROM ip_info WHERE ip = ?', (ip_address,)).fetchone()
+        if row is not None:
+            ip_info[ip_address] = _ip_info_record(ip_address, row[0])
+        if row is None or not is_ip_info_fresh('error' not in ip_info[ip_address], row[1], now):
+            missing.append(ip_address)
+    if missing:
+        logging.info("Fetching IP info for %d uncached addresses...", len(missing))
+        ip_info.update(fetch_ip_info_batch(sorted(missing), conn, ip_info))
+    return ip_info
+
+# Static parts of the HTML report, built once at import time
+_REPORT_HEAD = """
     <html>
         <head>
             <style>
-                body {{
+                body {
                     font-family: Arial, sans-serif;
                     color: #333;
-                }}
-                h1 {{
+                }
+                h1 {
                     color: #004080;
-                }}
-                p {{
+                }
+                p {
                     margin: 0 0 10px;
-                }}
-                table {{
+                }
+                table {
                     width: 100%;
                     border-collapse: collapse;
-                }}
-                th, td {{
+                }
+                th, td {
                     border: 1px solid #ddd;
                     padding: 8px;
-                }}
-                th {{
+                }
+                th {
                     padding-top: 12px;
                     padding-bottom: 12px;
                     text-align: left;
                     background-color: #004080;
                     color: white;
-                }}
-                .section {{
+                }
+                .section {
                     margin-bottom: 20px;
-                }}
-                .section-title {{
+                }
+                .section-title {
                     font-weight: bold;
                     text-decoration: underline;
-                }}
+                }
             </style>
         </head>
         <body>
             <h1>KRMS Devices Report</h1>
-            <div class="section">
+"""
+
+_REPORT_SUMMARY = """            <div class="section">
                 <p class="section-title">Summary:</p>
-                <p>Total Number of devices on KRMS: {stats['total_devices']}</p>
-                <p>Total Number of CAS activated devices: {stats['cas_activated']}</p>
-                <p>Total Number of devices in South Africa: <span style="color: green; font-weight: bold;">{stats['devices_in_sa']}</span></p>
-                <p>Devices not in South Africa: <span style="color: red; font-weight: bold;">{stats['devices_not_in_sa']}</span></p>
-                <p>Number of devices currently online: {stats['devices_online']}</p>
-                <p>Number of devices connected in the last 24 hours: {stats['connected_last_24h']}</p>
-                <p>New devices connected in the last 24 hours: {stats['new_connected_last_24h']}</p>
-                <p>New devices connected in the last 7 days: {stats['new_connected_last_7_days']}</p>
-                <p>New devices connected since the first of the month: {stats['new_connected_since_first_of_month']}</p>
+                <p>Total Number of devices on KRMS: {total_devices}</p>
+                <p>Total Number of CAS activated devices: {cas_activated}</p>
+                <p>Total Number of devices in South Africa: <span style="color: green; font-weight: bold;">{devices_in_sa}</span></p>
+                <p>Devices not in South Africa: <span style="color: red; font-weight: bold;">{devices_not_in_sa}</span></p>
+                <p>Number of devices currently online: {devices_online}</p>
+                <p>Number of devices connected in the last 24 hours: {connected_last_24h}</p>
+                <p>New devices connected in the last 24 hours: {new_connected_last_24h}</p>
+                <p>New devices connected in the last 7 days: {new_connected_last_7_days}</p>
+                <p>New devices connected since the first of the month: {new_connected_since_first_of_month}</p>
             </div>
-            <div class="section">
+"""
+
+_RETAILER_TABLE_HEAD = """            <div class="section">
                 <p class="section-title">Devices per retailer:</p>
                 <table>
                     <thead>
@@ -188,8 +357,19 @@ def generate_report(stats: Dict[str, Any], retailers: Dict[str, Dict[str, int]])
                     </thead>
                     <tbody>
     """
-    for retailer, counts in retailers.items():
-        report_content += f"""
+
+_REPORT_FOOTER = """
+                    </tbody>
+                </table>
+            </div>
+        </body>
+    </html>
+    """
+
+def generate_report(stats: Dict[str, Any], retailers: Dict[str, Dict[str, int]]) -> str:
+    """Generate a report with the collected statistics and return the report as a string."""
+    # Collect the rows and join once; repeated += on the growing report is quadratic in retailers
+    rows = [f"""
                         <tr>
                             <td>{retailer}</td>
                             <td>{counts['total']}</td>
@@ -200,16 +380,10 @@ def generate_report(stats: Dict[str, Any], retailers: Dict[str, Dict[str, int]])
                             <td>{counts['online_not_in_sa']}</td>
 
                         </tr>
-        """
-    
-    report_content += """
-                    </tbody>
-                </table>
-            </div>
-        </body>
-    </html>
-    """
-    
+        """ for retailer, counts in retailers.items()]
+
+    report_content = _REPORT_HEAD + _REPORT_SUMMARY.format(**stats) + _RETAILER_TABLE_HEAD + "".join(rows) + _REPORT_FOOTER
+
     with open(REPORT_FILE, 'w') as report:
         report.write(report_content)
 
@@ -217,212 +391,315 @@ def generate_report(stats: Dict[str, Any], retailers: Dict[str, Dict[str, int]])
 
 ATTACH_FILE = os.getenv('ATTACH_FILE', 'TRUE').upper() == 'TRUE'
 
-def send_email(report_content: str, attachment_path: str) -> None:
+# MIME types for the supported attachments, by file extension
+ATTACHMENT_TYPES = {
+    '.xlsx': ('application', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    '.gz': ('application', 'gzip')
+}
+
+def compress_csv(csv_path: str) -> str:
+    """Return a gzip-compressed copy of the CSV export, reusing the export itself if it is already compressed."""
+    if csv_path.endswith('.gz'):
+        return csv_path
+    gz_path = f"{csv_path}.gz"
+    with open(csv_path, 'rb') as source, gzip.open(gz_path, 'wb') as target:
+        shutil.copyfileobj(source, target)
+    return gz_path
+
+def get_attachment_path() -> Optional[str]:
+    """Return the file to attach to the report email for ATTACHMENT_FORMAT, or None for no attachment."""
+    if not ATTACH_FILE or ATTACHMENT_FORMAT == 'none':
+        return None
+    if ATTACHMENT_FORMAT == 'csv.gz':
+        return compress_csv(CSV_OUTPUT_FILE)
+    return XLSX_OUTPUT_FILE or None
+
+def send_email(report_content: str, attachment_path: Optional[str]) -> None:
     """Send an email with the report and attachment."""
-    msg = MIMEMultipart()
+    msg = EmailMessage()
     msg['From'] = EMAIL_USERNAME
     msg['To'] = ', '.join(EMAIL_TO)
     msg['Subject'] = EMAIL_SUBJECT
+    msg.set_content(report_content, subtype='html')
 
-    # Attach the body with the msg instance
-    msg.attach(MIMEText(report_content, 'html'))
-
-    if ATTACH_FILE:
-        # Open the file to be sent
+    if attachment_path is not None:
+        maintype, subtype = ATTACHMENT_TYPES.get(os.path.splitext(attachment_path)[1], ('application', 'octet-stream'))
         with open(attachment_path, "rb") as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-
-        encoders.encode_base64(part)
-        part.add_header('Content-Disposition', f"attachment; filename= {os.path.basename(attachment_path)}")
-        msg.attach(part)
+            msg.add_attachment(attachment.read(), maintype=maintype, subtype=subtype,
+                               filename=os.path.basename(attachment_path))
 
     # Send the message via the SMTP server
     try:
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        if TTLS:
-            server.starttls()
-        if LOGIN_REQUIRED:
-            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
-        server.sendmail(EMAIL_USERNAME, EMAIL_TO, msg.as_string())
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
+            if TTLS:
+                server.starttls()
+            if LOGIN_REQUIRED:
+                server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+            server.send_message(msg, from_addr=EMAIL_USERNAME, to_addrs=EMAIL_TO)
         logging.info("Email sent successfully.")
-        server.quit()
     except Exception as e:
         logging.error(f"Failed to send email: {e}")
 
-def process_devices(devices: list, ip_info_cache: dict) -> tuple:
-    """Process devices and gather statistics."""
-    csv_headers = list(devices[0].keys()) if devices else []
+def process_devices(pages: Iterable[List[dict]], ip_info_db: sqlite3.Connection) -> tuple:
+    """Process devices page by page, streaming them to the export files and gathering statistics."""
+    pages = iter(pages)
+    first_page = next(pages, [])
+    pages = itertools.chain([first_page], pages)
+    csv_headers = list(first_page[0].keys()) if first_page else []
     if "country" not in csv_headers:
         csv_headers.append("country")
 
-    stats = {
-        'total_devices': len(devices),
-        'cas_activated': 0,
-        'devices_in_sa': 0,
-        'devices_not_in_sa': 0,
-        'devices_online': 0,
-        'connected_last_24h': 0,
-        'new_connected_last_24h': 0,
-        'new_connected_last_7_days': 0,
-        'new_connected_since_first_of_month': 0
-    }
-    retailers = {}
-
+    # Counters are kept in locals inside the loop and collected into the stats dict at the end
+    total_devices = cas_activated = devices_in_sa = devices_online = 0
+    connected_last_24h = new_connected_last_24h = new_connected_last_7_days = new_connected_since_first_of_month = 0
+    seen_ids = set()
+    duplicates = 0
+    retailers = defaultdict(lambda: {
+        'total': 0,
+        'activated': 0,
+        'in_sa': 0,
+        'cas_not_in_sa': 0,
+        'cas_in_sa': 0,
+        'online_not_in_sa': 0
+    })
+
+    # Time window thresholds as epoch seconds, compared directly against the API timestamps
     now = datetime.now()
-    first_of_month = now.replace(day=1)
-
-    with open(CSV_OUTPUT_FILE, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=csv_headers)
-        writer.writeheader()
-
-        for device in devices:
-            device_id = device.get('device_id')  # Use 'device_id'
-
-            if not device_id:
-                logging.warning(f"Skipping device with missing ID. Full data: {device}")
-                continue
-
-            ip_address = device.get('locationIp')
-            if ip_address:
-                try:
-                    ip_info = fetch_ip_info(ip_address, ip_info_cache)  # Handle IPFetchError
-                except IPFetchError as e:
-                    logging.error(str(e))
-                    continue  # Skip to the next device if IP fetch fails
-
-                if 'error' not in ip_info:
-                    ip_province = ip_info.get('region')
-                    ip_city = ip_info.get('city')
-                    ip_latitude, ip_longitude = map(float, ip_info.get('loc', '0,0').split(','))
-                    ip_country = ip_info.get('country')
-
-                    # Compare and update logic
-                    if (device.get('province') != ip_province or 
-                        device.get('city') != ip_city or 
-                        device.get('latitude') != ip_latitude or 
-                        device.get('longitude') != ip_longitude or
-                        device.get('country') != ip_country):
-                        
-                        device['province'] = ip_province
-                        device['city'] = ip_city
-                        device['latitude'] = ip_latitude
-                        device['longitude'] = ip_longitude
-                        device['country'] = ip_country
-
-            # Update statistics
-            activation_status = device.get('cpeServiceStatus')
-            if (isinstance(activation_status, bool) and activation_status) or (isinstance(activation_status, str) and activation_status.lower() == 'activated'):
-                stats['cas_activated'] += 1
-
-            if device.get('country') == 'ZA':
-                stats['devices_in_sa'] += 1
-
-            if (isinstance(device.get('online'), bool) and device['online']) or (isinstance(device.get('online'), str) and device['online'].lower() == 'true'):
-                stats['devices_online'] += 1
-
-            # Check connection times
-            sync_time = device.get('syncTime')
-            connected_time = device.get('connectedTime')
-
-            if sync_time:
-                sync_time = datetime.fromtimestamp(sync_time)
-                if sync_time >= now - timedelta(days=1):
-                    stats['connected_last_24h'] += 1
-
-            if connected_time:
-                connected_time = datetime.fromtimestamp(connected_time)
-                if connected_time >= now - timedelta(days=1):
-                    stats['new_connected_last_24h'] += 1
-                if connected_time >= now - timedelta(days=7):
-                    stats['new_connected_last_7_days'] += 1
-                if connected_time >= first_of_month:
-                    stats['new_connected_since_first_of_month'] += 1
-
-            retailer = device.get('retailer', 'No Retailer Added')
-            if retailer in retailers:
-                retailers[retailer]['total'] += 1
-                if (isinstance(activation_status, bool) and activation_status) or (isinstance(activation_status, str) and activation_status.lower() == 'activated'):
-                    retailers[retailer]['activated'] += 1
-                if device.get('country') == 'ZA':
-                    retailers[retailer]['in_sa'] += 1
-                if (isinstance(activation_status, bool) and activation_status) or (isinstance(activation_status, str) and activation_status.lower() == 'activated') and device.get('country') != 'ZA':
-                    retailers[retailer]['cas_not_in_sa'] += 1
-                if (isinstance(activation_status, bool) and activation_status) or (isinstance(activation_status, str) and activation_status.lower() == 'activated') and device.get('country') == 'ZA':
-                    retailers[retailer]['cas_in_sa'] += 1
-                if (device.get('country') != 'ZA' and device.get('country') != '') and (device.get('connectedTime') != 0):
-                        retailers[retailer]['online_not_in_sa'] += 1
-
-            else:
-                retailers[retailer] = {
-                    'total': 1,
-                    'activated': 1 if (isinstance(activation_status, bool) and activation_status) or (isinstance(activation_status, str) and activation_status.lower() == 'activated') else 0,
-                    'in_sa': 1 if device.get('country') == 'ZA' else 0,
-                    'cas_not_in_sa': 1 if (isinstance(activation_status, bool) and activation_status) or (isinstance(activation_status, str) and activation_status.lower() == 'activated') and device.get('country') != 'ZA' else 0,
-                    'cas_in_sa': 1 if (isinstance(activation_status, bool) and activation_status) or (isinstance(activation_status, str) and activation_status.lower() == 'activated') and device.get('country') == 'ZA' else 0,
-                    'online_not_in_sa': 1 if (isinstance(device.get('online'), bool) and device['online']) or (isinstance(device.get('online'), str) and device['online'].lower() == 'true') and device.get('country') != 'ZA' and device.get('country') != '' else 0
-                }
-
-            writer.writerow(device)
+    last_24h = (now - timedelta(days=1)).timestamp()
+    last_7_days = (now - timedelta(days=7)).timestamp()
+    since_first_of_month = now.replace(day=1).timestamp()
+
+    # Stream rows to both outputs; constant_memory flushes each XLSX row to disk as soon as the next one starts.
+    # xlsxwriter is only imported when the XLSX export is actually written.
+    workbook = worksheet = None
+    if WRITE_XLSX:
+        import xlsxwriter
+        workbook = xlsxwriter.Workbook(XLSX_OUTPUT_FILE, {
+            'constant_memory': True,
+            'strings_to_formulas': False,
+            'strings_to_urls': False
+        })
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, csv_headers)
+    xlsx_row = 1
 
-    # Save data to XLSX
-    df = pd.DataFrame(devices)
-    df.to_excel(XLSX_OUTPUT_FILE, index=False)
+    # A CSV_OUTPUT_FILE ending in .gz is compressed as it is written
+    opener = gzip.open if CSV_OUTPUT_FILE.endswith('.gz') else open
+    try:
+        with opener(CSV_OUTPUT_FILE, 'wt', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(csv_headers)
+
+            for devices in pages:
+                # Page-local lookup table, so the per-device loop never queries the cache database
+                page_ip_info = prefetch_ip_info(devices, ip_info_db)
+                total_devices += len(devices)
+
+                for device in devices:
+                    device_id = device.get('device_id')  # Use 'device_id'
+
+                    if not device_id:
+                        logging.warning(f"Skipping device with missing ID. Full data: {device}")
+                        continue
+
+                    # A device can be returned twice if it moved between pages while they were read.
+                    # Only the IDs are kept, so this costs far less memory than buffering the devices themselves.
+                    if device_id in seen_ids:
+                        duplicates += 1
+                        total_devices -= 1
+                        continue
+                    seen_ids.add(device_id)
+
+                    ip_address = device.get('locationIp')
+                    if ip_address:
+                        # A failed lookup returns an error record; the device is still exported, just not enriched
+                        ip_info = page_ip_info[ip_address]
+                        if 'error' not in ip_info:
+                            ip_province = ip_info.get('region')
+                            ip_city = ip_info.get('city')
+                            ip_latitude, ip_longitude = map(float, ip_info.get('loc', '0,0').split(','))
+                            ip_country = ip_info.get('country')
+
+                            # Compare and update logic
+                            if (device.get('province') != ip_province or 
+                                device.get('city') != ip_city or 
+                                device.get('latitude') != ip_latitude or 
+                                device.get('longitude') != ip_longitude or
+                                device.get('country') != ip_country):
+                            
+                                device['province'] = ip_province
+                                device['city'] = ip_city
+                                device['latitude'] = ip_latitude
+                                device['longitude'] = ip_longitude
+                                device['country'] = ip_country
+
+                    # Evaluate each device flag once and reuse it for all counters below
+                    activation_status = device.get('cpeServiceStatus')
+                    is_activated = activation_status is True or (isinstance(activation_status, str) and activation_status.lower() == 'activated')
+                    online = device.get('online')
+                    is_online = online is True or (isinstance(online, str) and online.lower() == 'true')
+                    country = device.get('country')
+                    is_za = country == 'ZA'
+
+                    # Update statistics
+                    cas_activated += is_activated
+                    devices_in_sa += is_za
+                    devices_online += is_online
+
+                    # Check connection times
+                    sync_time = device.get('syncTime')
+                    connected_time = device.get('connectedTime')
+
+                    if sync_time and sync_time >= last_24h:
+                        connected_last_24h += 1
+
+                    if connected_time:
+                        new_connected_last_24h += connected_time >= last_24h
+                        new_connected_last_7_days += connected_time >= last_7_days
+                        new_connected_since_first_of_month += connected_time >= since_first_of_month
+
+                    counts = retailers[device.get('retailer', 'No Retailer Added')]
+                    counts['total'] += 1
+                    counts['activated'] += is_activated
+                    counts['in_sa'] += is_za
+                    counts['cas_in_sa'] += is_activated and is_za
+                    counts['cas_not_in_sa'] += is_activated and not is_za
+                    counts['online_not_in_sa'] += is_online and not is_za and country != ''
+
+                    # Extract the row once and share it between both outputs
+                    row = [device.get(header) for header in csv_headers]
+                    writer.writerow(row)
+                    if worksheet is not None:
+                        if xlsx_row == XLSX_MAX_ROWS:
+                            # Excel sheets hold at most XLSX_MAX_ROWS rows; continue on a new sheet instead of dropping rows
+                            worksheet = workbook.add_worksheet()
+                            worksheet.write_row(0, 0, csv_headers)
+                            xlsx_row = 1
+                            logging.info("XLSX sheet is full, continuing on %s.", worksheet.name)
+                        if worksheet.write_row(xlsx_row, 0, row) == -1:
+                            raise ExportError(f"Failed to write XLSX row {xlsx_row} on {worksheet.name}")
+                        xlsx_row += 1
+    finally:
+        # Close even if writing fails part way, so constant_memory cleans up its temporary files
+        if workbook is not None:
+            workbook.close()
+
+    if duplicates:
+        logging.warning("Skipped %d devices returned more than once while paging.", duplicates)
 
-    stats['devices_not_in_sa'] = stats['cas_activated'] - stats['devices_in_sa']
+    stats = {
+        'total_devices': total_devices,
+        'cas_activated': cas_activated,
+        'devices_in_sa': devices_in_sa,
+        'devices_not_in_sa': cas_activated - devices_in_sa,
+        'devices_online': devices_online,
+        'connected_last_24h': connected_last_24h,
+        'new_connected_last_24h': new_connected_last_24h,
+        'new_connected_last_7_days': new_connected_last_7_days,
+        'new_connected_since_first_of_month': new_connected_since_first_of_month
+    }
 
-    return stats, retailers
+    return stats, dict(retailers)
+
+def iter_device_pages(session: httpx.Client, url: str, headers: dict) -> Iterator[List[dict]]:
+    """Yield pages of devices from the API, starting at PAGE and stopping after LIMIT devices."""
+    # Paging is by offset, so rows must keep their position between requests. PAGINATION_ORDER breaks ties;
+    # sorting on a field that changes during the run (e.g. syncTime) can still move devices across pages.
+    orders = ORDERS + [PAGINATION_ORDER] if PAGINATION_ORDER and PAGINATION_ORDER not in ORDERS else ORDERS
+    fetched = 0
+    for page in itertools.count(PAGE):
+        logging.info("Requesting devices page %d...", page)
+        devices_data = request_data(session, url, headers, data={
+            "page": page,
+            "limit": PAGE_SIZE,
+            "keyword": {},
+            "orders": orders,
+        })
+        devices = (devices_data.get('data') or [])[:LIMIT - fetched]
+        if not devices:
+            return
+        fetched += len(devices)
+        logging.info("Received %d devices (%d total).", len(devices), fetched)
+        yield devices
+        if len(devices) < PAGE_SIZE or fetched >= LIMIT:
+            return
+
+def create_session() -> httpx.Client:
+    """Create an HTTP/2 client that keeps connections to the KRMS API alive and accepts compressed responses."""
+    return httpx.Client(
+        http2=True,
+        headers={"Accept-Encoding": "br, gzip"},
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+        follow_redirects=True
+    )
 
 def main() -> None:
     """Main function to execute the script."""
     logging.info("Script started.")
+    session = create_session()
     try:
-        token = request_token()
-    except Exception as e:
+        run(session)
+    finally:
+        session.close()
+
+def run(session: httpx.Client) -> None:
+    """Fetch, process and report on the KRMS devices using the given session."""
+    try:
+        token = get_token(session)
+    except TokenError as e:
         logging.error("Failed to obtain token: %s", e)
         return
 
-    profile_url = "https://www.krms.openview.co.za/auth/v1/profile"
-    user_url = "https://www.krms.openview.co.za/api/v1/iams/user"
-    devices_url = "https://www.krms.openview.co.za/api/v1/devices/connects/page"
+    profile_url = f"{KRMS_BASE_URL}/auth/v1/profile"
+    user_url = f"{KRMS_BASE_URL}/api/v1/iams/user"
+    devices_url = f"{KRMS_BASE_URL}/api/v1/devices/connects/page"
     headers = {
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json;charset=utf-8",
         "User-Agent": "Mozilla/5.0"
     }
 
-    try:
-        logging.info("Requesting profile data...")
-        profile_data = request_data(profile_url, headers)
-        logging.info("Profile data received.")
-        
-        logging.info("Requesting user data...")
-        user_data = request_data(user_url, headers)
-        logging.info("User data received.")
-        
-        logging.info("Requesting devices data...")
-        devices_data = request_data(devices_url, headers, data={
-            "page": PAGE,
-            "limit": LIMIT,
-            "keyword": {},
-            "orders": ORDERS,
-        })
-        logging.info("Devices data received.")
-    except requests.RequestException as e:
-        logging.error("Error requesting data: %s", e)
+    # Profile, user and the first devices page are independent, so request them concurrently
+    logging.info("Requesting profile, user and devices data...")
+    pages = iter_device_pages(session, devices_url, headers)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        profile_future = executor.submit(request_data, session, profile_url, headers)
+        user_future = executor.submit(request_data, session, user_url, headers)
+        first_page_future = executor.submit(next, pages, None)
+        try:
+            profile_data = profile_future.result()
+            logging.info("Profile data received.")
+            user_data = user_future.result()
+            logging.info("User data received.")
+            first_page = first_page_future.result()
+        except (httpx.HTTPError, ValueError, TokenError) as e:
+            logging.error("Error requesting data: %s", e)
+            return
+
+    if not first_page:
+        logging.info("No devices data found.")
         return
 
     # Load IP info cache
-    ip_info_cache = load_ip_info()
-    devices = devices_data.get('data', [])
-
-    if not devices:
-        logging.info("No devices data found.")
+    ip_info_db = load_ip_info()
+    try:
+        stats, retailers = process_devices(itertools.chain([first_page], pages), ip_info_db)
+    except (httpx.HTTPError, ValueError, TokenError) as e:
+        logging.error("Error requesting devices data: %s", e)
         return
-
-    stats, retailers = process_devices(devices, ip_info_cache)
-
-    logging.info(f"Data successfully exported to {CSV_OUTPUT_FILE} and {XLSX_OUTPUT_FILE}")
+    except ExportError as e:
+        logging.error("Error writing export files: %s", e)
+        return
+    finally:
+        # Commit the cache once per run, even if processing fails part way
+        save_ip_info(ip_info_db)
+        ip_info_db.close()
+
+    if WRITE_XLSX:
+        logging.info(f"Data successfully exported to {CSV_OUTPUT_FILE} and {XLSX_OUTPUT_FILE}")
+    else:
+        logging.info(f"Data successfully exported to {CSV_OUTPUT_FILE}")
     logging.info("Script completed.")
 
     # Generate and log report
@@ -430,7 +707,7 @@ def main() -> None:
 
     # Send email if required
     if SEND_EMAIL:
-        send_email(report_content, XLSX_OUTPUT_FILE)
+        send_email(report_content, get_attachment_path())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file